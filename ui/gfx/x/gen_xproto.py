@@ -11,6 +11,7 @@
 #
 # The generated header and source files will look like this:
 
+# // GEN-HASH: 0f3c...
 # #ifndef GEN_UI_GFX_X_XPROTO_H_
 # #define GEN_UI_GFX_X_XPROTO_H_
 #
@@ -21,6 +22,7 @@
 # #include <vector>
 #
 # #include "base/component_export.h"
+# #include "base/containers/span.h"
 # #include "ui/gfx/x/xproto_types.h"
 #
 # typedef struct _XDisplay XDisplay;
@@ -37,11 +39,13 @@
 #     uint16_t red{};
 #     uint16_t green{};
 #     uint16_t blue{};
+#     uint8_t pad0[2]{};
 #   };
+#   static_assert(sizeof(RGB) == 8, "");
 #
 #   struct QueryColorsRequest {
 #     uint32_t cmap{};
-#     std::vector<uint32_t> pixels{};
+#     base::span<const uint32_t> pixels{};
 #   };
 #
 #   struct QueryColorsReply {
@@ -57,10 +61,14 @@
 #   XDisplay* display_;
 # };
 #
+# template <>
+# struct IsFlatWire<XProto::RGB> : std::true_type {};
+#
 # }  // namespace x11
 #
 # #endif  // GEN_UI_GFX_X_XPROTO_H_
 
+# // GEN-HASH: 0f3c...
 # #include "xproto.h"
 #
 # #include <xcb/xcb.h>
@@ -77,6 +85,7 @@
 # XProto::QueryColors(
 #     const XProto::QueryColorsRequest& request) {
 #   WriteBuffer buf;
+#   buf.reserve(8 + 4 * request.pixels.size());
 #
 #   auto& cmap = request.cmap;
 #   auto& pixels = request.pixels;
@@ -86,21 +95,16 @@
 #   uint8_t major_opcode = 91;
 #   Write(&major_opcode, &buf);
 #
-#   // pad0
-#   Pad(&buf, 1);
-#
-#   // length
-#   // Caller fills in length for writes.
-#   Pad(&buf, sizeof(uint16_t));
+#   // pad0, length
+#   // SendRequest() fills in length.
+#   Pad(&buf, 3);
 #
 #   // cmap
 #   Write(&cmap, &buf);
 #
 #   // pixels
 #   DCHECK_EQ(static_cast<size_t>(pixels_len), pixels.size());
-#   for (auto& pixels_elem : pixels) {
-#     Write(&pixels_elem, &buf);
-#   }
+#   WriteFlat(pixels.data(), pixels.size(), &buf);
 #
 #   return x11::SendRequest<XProto::QueryColorsReply>(display_, &buf);
 # }
@@ -137,24 +141,7 @@
 #
 #   // colors
 #   colors.resize(colors_len);
-#   for (auto& colors_elem : colors) {
-#     auto& red = colors_elem.red;
-#     auto& green = colors_elem.green;
-#     auto& blue = colors_elem.blue;
-#
-#     // red
-#     Read(&red, &buf);
-#
-#     // green
-#     Read(&green, &buf);
-#
-#     // blue
-#     Read(&blue, &buf);
-#
-#     // pad0
-#     Pad(&buf, 2);
-#
-#   }
+#   ReadFlat(colors.data(), colors.size(), &buf);
 #
 #   Align(&buf, 4);
 #   DCHECK_EQ(buf.offset < 32 ? 0 : buf.offset - 32, 4 * length);
@@ -164,18 +151,26 @@
 #
 # }  // namespace x11
 
-from __future__ import print_function
-
 import argparse
 import collections
+import hashlib
 import os
 import sys
 import types
+import xml.etree.ElementTree
 
 # __main__.output must be defined before importing xcbgen,
 # so this global is unavoidable.
 output = collections.defaultdict(int)
 
+# Precomputed left-padding for each indentation level.
+INDENTS = tuple('  ' * i for i in range(16))
+
+# Templates for the most commonly generated statements, indexed by
+# GenXproto.is_read.
+COPY_PRIMITIVE = ('Write(&%s, &buf);', 'Read(&%s, &buf);')
+COPY_FLAT = ('WriteFlat(%s, %s, &buf);', 'ReadFlat(%s, %s, &buf);')
+
 
 # Left-pad with 2 spaces while this class is alive.
 class Indent:
@@ -222,26 +217,38 @@ class ScopedFields:
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
         for _ in range(self.n_pushed):
-            self.xproto.scope.pop()
+            field = self.xproto.scope.pop()
+            self.xproto.scope_index[field.field_name].pop()
+
+
+# C++ keywords and other identifiers that can't be used as field names.
+RESERVED = frozenset([
+    'and',
+    'xor',
+    'or',
+    'class',
+    'explicit',
+    'new',
+    'delete',
+    'default',
+    'private',
+])
+
+# Memoized results of safe_name().
+safe_names = {}
 
 
 # Ensures |name| is usable as a C++ field by avoiding keywords and
 # symbols that start with numbers.
 def safe_name(name):
-    RESERVED = [
-        'and',
-        'xor',
-        'or',
-        'class',
-        'explicit',
-        'new',
-        'delete',
-        'default',
-        'private',
-    ]
-    if name[0].isdigit() or name in RESERVED:
-        return 'c_' + name
-    return name
+    safe = safe_names.get(name)
+    if safe is None:
+        if name[0].isdigit() or name in RESERVED:
+            safe = 'c_' + name
+        else:
+            safe = name
+        safe_names[name] = safe
+    return safe
 
 
 class GenXproto:
@@ -251,14 +258,62 @@ class GenXproto:
         self.prev_id = -1
         self.indent = 0
         self.file = None
+        self.lines = []
+        self.last_was_blank = False
         self.is_read = False
         self.scope = []
-        self.namespace = []
-
-    # Write a line to the current file.
+        # Maps field names to the stack of in-scope fields with that name.
+        self.scope_index = collections.defaultdict(list)
+        self.namespace = ()
+        self.qualtypes = {}
+        self.flat_wire_sizes = {}
+        self.exprs = {}
+        self.flat_structs = []
+        # Static offset of the cursor into the buffer, or None if it
+        # depends on the contents of the buffer.
+        self.offset = None
+        # Padding deferred by copy_pad() that hasn't been written yet.
+        self.pad_names = []
+        self.pad_size = 0
+        # Notes explaining caller-filled fields folded into the padding.
+        self.pad_notes = []
+        # Dispatch on exact classes rather than calling isinstance().
+        self.kinds = {
+            xcbgen.xtypes.Error: 'Error',
+            xcbgen.xtypes.Request: 'Request',
+            xcbgen.xtypes.Enum: 'Enum',
+        }
+
+    # Buffer a line to be written to the current file.
     def write(self, line=''):
+        # Never emit more than one blank line in a row.
+        if not line:
+            if self.last_was_blank:
+                return
+            self.last_was_blank = True
+        else:
+            self.last_was_blank = False
         indent = self.indent if line and not line.startswith('#') else 0
-        print(('  ' * indent) + line, file=self.file)
+        pad = INDENTS[indent] if indent < len(INDENTS) else '  ' * indent
+        self.lines.append(pad + line + '\n')
+
+    # Open and close an indented block.  These are cheaper than Indent for
+    # the common case where no cleanup is needed if generation fails.
+    def open_block(self, opening_line='{'):
+        self.write(opening_line)
+        self.indent += 1
+
+    def close_block(self, closing_line='}'):
+        self.indent -= 1
+        self.write(closing_line)
+
+    # Write all buffered lines to the current file at once.
+    def flush(self):
+        # Binary mode bypasses newline translation and buffered text I/O.
+        with open(self.file, 'wb') as f:
+            f.write(''.join(self.lines).encode('utf-8'))
+        del self.lines[:]
+        self.last_was_blank = False
 
     # Geenerate an ID suitable for use in temporary variable names.
     def new_uid(self, ):
@@ -266,10 +321,9 @@ class GenXproto:
         return self.prev_id
 
     def type_suffix(self, t):
-        if isinstance(t, self.xcbgen.xtypes.Error):
-            return 'Error'
-        elif isinstance(t, self.xcbgen.xtypes.Request):
-            return 'Request'
+        kind = self.kinds.get(t.__class__)
+        if kind in ('Error', 'Request'):
+            return kind
         elif t.is_reply:
             return 'Reply'
         elif t.is_event:
@@ -279,6 +333,14 @@ class GenXproto:
     # Given an xcbgen.xtypes.Type, returns a C++-namespace-qualified
     # string that looks like Input::InputClass::Key.
     def qualtype(self, t):
+        key = (id(t), t.name, self.namespace)
+        qualname = self.qualtypes.get(key)
+        if qualname is None:
+            qualname = self.qualtypes[key] = self.compute_qualtype(t)
+        return qualname
+
+    # Uncached implementation of qualtype().
+    def compute_qualtype(self, t):
         # Work around a bug in xcbgen: ('int') should have been ('int',)
         name = list(('int', ) if t.name == 'int' else t.name)
         name[-1] += self.type_suffix(t)
@@ -292,11 +354,17 @@ class GenXproto:
                 name[1:1] = ['XProto']
 
         # Try to avoid adding namespace qualifiers if they're not necessary.
-        chop = 0
-        for t1, t2 in zip(name, self.namespace):
-            if t1 != t2:
-                break
-            chop += 1
+        # Most types live directly in the current namespace, so check for
+        # a full prefix match first.
+        ns = self.namespace
+        name = tuple(name)
+        if name[:len(ns)] == ns:
+            chop = len(ns)
+        else:
+            chop = 0
+            limit = min(len(name), len(ns))
+            while chop < limit and name[chop] == ns[chop]:
+                chop += 1
         return '::'.join(name[chop:])
 
     def add_field_to_scope(self, field, obj):
@@ -304,6 +372,7 @@ class GenXproto:
             return 0
 
         self.scope.append(field)
+        self.scope_index[field.field_name].append(field)
 
         field_name = safe_name(field.field_name)
         # There's one case where we would have generated:
@@ -327,10 +396,8 @@ class GenXproto:
     # Lookup |name| in the current scope.  Returns the deepest
     # (most local) occurrence of |name|.
     def field_from_scope(self, name):
-        for field in reversed(self.scope):
-            if field.field_name == name:
-                return field
-        return None
+        fields = self.scope_index.get(name)
+        return fields[-1] if fields else None
 
     # Work around conflicts caused by Xlib's liberal use of macros.
     def undef(self, name):
@@ -338,7 +405,22 @@ class GenXproto:
         self.write('#undef %s' % name)
         self.write('#endif')
 
+    # Returns a C++ expression for the xcbgen expression |expr|.
     def expr(self, expr):
+        key = (id(expr), self.namespace)
+        result = self.exprs.get(key)
+        if result is not None:
+            return result
+        prev_id = self.prev_id
+        result = self.compute_expr(expr)
+        # Expressions containing sumof write the sum to a new temporary
+        # variable, so they must be regenerated every time.
+        if self.prev_id == prev_id:
+            self.exprs[key] = result
+        return result
+
+    # Uncached implementation of expr().
+    def compute_expr(self, expr):
         if expr.op == 'popcount':
             return 'PopCount(%s)' % self.expr(expr.rhs)
         if expr.op == '~':
@@ -375,35 +457,210 @@ class GenXproto:
         return expr.lenfield_name
 
     def copy_primitive(self, name):
-        self.write(
-            '%s(&%s, &buf);' % ('Read' if self.is_read else 'Write', name))
+        self.write(COPY_PRIMITIVE[self.is_read] % name)
+
+    # Copies a list of |count| objects starting at |data| with a single
+    # memcpy.
+    def copy_flat(self, data, count):
+        self.write(COPY_FLAT[self.is_read] % (data, count))
+
+    # If the C++ declaration of |struct| has exactly the same layout as
+    # its wire format, returns its size in bytes.  Otherwise returns 0.
+    def flat_wire_size(self, struct):
+        key = id(struct)
+        size = self.flat_wire_sizes.get(key)
+        if size is None:
+            size = self.flat_wire_sizes[key] = self.compute_flat_size(struct)
+        return size
+
+    # Uncached implementation of flat_wire_size().
+    def compute_flat_size(self, struct):
+        if (not struct.is_container or struct.is_union or struct.is_switch
+                or self.type_suffix(struct)):
+            return 0
+        size = 0
+        max_align = 1
+        padded = False
+        for field in struct.fields:
+            t = field.type
+            # Trailing padding is declared as an array member, so that
+            # structs like RGB {red, green, blue, pad0[2]} are still flat.
+            if field.wire and t.is_pad and t.align <= 1:
+                size += t.nmemb
+                padded = True
+                continue
+            if padded:
+                return 0
+            if not field.wire or not field.visible or not t.is_simple:
+                return 0
+            # X11 types are aligned to their size on the wire, so the C++
+            # compiler must not need to insert any padding.
+            if not t.size or size % t.size:
+                return 0
+            size += t.size
+            max_align = max(max_align, t.size)
+        return size if size % max_align == 0 else 0
+
+    # Returns a C++ expression for the number of bytes to reserve for
+    # |struct| on the wire, rounded up to a multiple of 4 like every
+    # request.  Variable-length lists are sized from the members of |obj|
+    # and switches by their largest payload.  Unions, lists of irregular
+    # elements and other fields without a static size are not counted.
+    def wire_size(self, struct, obj):
+        size = 0
+        terms = []
+        # Static offset modulo 4 used to resolve alignment pads, or None
+        # if it depends on the contents of |obj|.
+        offset = 0
+        fields = [field for field in struct.fields if field.wire]
+        for i, field in enumerate(fields):
+            t = field.type
+            if t.is_pad and t.align > 1:
+                # Trailing alignment is covered by rounding up the total.
+                if i == len(fields) - 1:
+                    continue
+                # Assume the worst case if the offset isn't known.
+                pad = t.align - 1 if offset is None else -offset % t.align
+                size += pad
+                if offset is not None:
+                    offset = (offset + pad) % 4
+                continue
+            if t.is_list and not t.nmemb:
+                elem_size = self.elem_wire_size(t.member)
+                if elem_size:
+                    list_name = '%s.%s' % (obj, safe_name(field.field_name))
+                    terms.append((elem_size, list_name))
+                if not elem_size or elem_size % 4:
+                    offset = None
+                continue
+            if t.is_switch:
+                field_size = self.switch_wire_size(t)
+                offset = None
+            else:
+                field_size = self.fixed_wire_size(t)
+            if field_size is None:
+                offset = None
+            else:
+                size += field_size
+                if offset is not None:
+                    offset = (offset + field_size) % 4
+
+        list_sizes = ['%d * %s.size()' % term for term in terms]
+        if all([elem_size % 4 == 0 for elem_size, _ in terms]):
+            return ' + '.join([str(-(-size // 4) * 4)] + list_sizes)
+        return '(%s + 3) & ~3' % ' + '.join([str(size)] + list_sizes)
+
+    # Returns the number of bytes the fixed-size field type |t| occupies
+    # on the wire, or None if its size depends on its contents.
+    def fixed_wire_size(self, t):
+        if t.is_pad:
+            return t.nmemb if t.align <= 1 else t.align - 1
+        if t.is_list:
+            elem_size = self.elem_wire_size(t.member)
+            return elem_size * t.nmemb if t.nmemb and elem_size else None
+        if t.is_simple or t.is_expr:
+            return t.size
+        if t.is_container and not t.is_switch:
+            return self.flat_wire_size(t) or None
+        return None
+
+    # Returns the largest number of bytes |switch| can occupy on the wire:
+    # the sum of all bitcases, or the largest case.  Returns None if any
+    # case has a variable size.
+    def switch_wire_size(self, switch):
+        case_sizes = []
+        for case in switch.bitcases:
+            case_size = 0
+            for field in case.type.fields:
+                field_size = self.fixed_wire_size(field.type)
+                if field_size is None:
+                    return None
+                case_size += field_size
+            case_sizes.append(case_size)
+        if all([case.type.is_bitcase for case in switch.bitcases]):
+            return sum(case_sizes)
+        return max(case_sizes) if case_sizes else 0
+
+    # If lists of |t| can be copied with a single memcpy, returns the size
+    # of one element in bytes.  Otherwise returns 0.
+    def elem_wire_size(self, t):
+        return t.size if t.is_simple else self.flat_wire_size(t)
+
+    # Moves the static offset forward by |size| bytes.  A |size| of None
+    # means the field has a dynamic size.
+    def advance(self, size):
+        if self.offset is not None and size is not None:
+            self.offset += size
+        else:
+            self.offset = None
+
+    # If |field| is padding, defers writing it so that consecutive pads
+    # are combined into a single Pad().  Returns true if |field| was
+    # handled.
+    def copy_pad(self, field):
+        t = field.type
+        if t.is_pad:
+            if t.align > 1:
+                assert t.nmemb == 1
+                assert t.align in (2, 4)
+                # Alignment can only be resolved statically if the
+                # offset is known.
+                if self.offset is None:
+                    return False
+                size = -self.offset % t.align
+            else:
+                size = t.nmemb
+        elif self.is_caller_filled(field):
+            size = t.size
+            if field.field_name == 'length':
+                self.pad_notes.append('SendRequest() fills in length.')
+            else:
+                self.pad_notes.append('Caller fills in extension major opcode.')
+        else:
+            return False
+
+        if size:
+            self.pad_names.append(safe_name(field.field_name))
+            self.pad_size += size
+            self.advance(size)
+        return True
+
+    # Callers fill in the length and extension major opcode for writes.
+    def is_caller_filled(self, field):
+        if self.is_read or field.visible:
+            return False
+        if field.field_name == 'length':
+            return True
+        return field.field_name == 'major_opcode' and any(
+            [f.field_name == 'minor_opcode' for f in field.parent.fields])
+
+    # Writes padding deferred by copy_pad().  Returns true if anything
+    # was written.
+    def flush_pad(self):
+        if not self.pad_names:
+            return False
+        self.write('// ' + ', '.join(self.pad_names))
+        for note in self.pad_notes:
+            self.write('// ' + note)
+        self.write('Pad(&buf, %d);' % self.pad_size)
+        self.pad_names = []
+        self.pad_size = 0
+        self.pad_notes = []
+        return True
 
     def copy_special_field(self, field):
         type_name = self.qualtype(field.type)
         name = safe_name(field.field_name)
 
+        # Fields filled in by the caller are handled by copy_pad().
         if name in ('major_opcode', 'minor_opcode'):
             assert not self.is_read
-            is_ext = any(
-                [f.field_name == 'minor_opcode' for f in field.parent.fields])
-            if is_ext and name == 'major_opcode':
-                self.write('// Caller fills in extension major opcode.')
-                self.write('Pad(&buf, sizeof(%s));' % type_name)
-            else:
-                self.write(
-                    '%s %s = %s;' % (type_name, name, field.parent.opcode))
-                self.copy_primitive(name)
-        elif name in ('response_type', 'sequence', 'extension'):
+            self.write('%s %s = %s;' % (type_name, name, field.parent.opcode))
+            self.copy_primitive(name)
+        elif name in ('response_type', 'sequence', 'extension', 'length'):
             assert self.is_read
             self.write('%s %s;' % (type_name, name))
             self.copy_primitive(name)
-        elif name == 'length':
-            if not self.is_read:
-                self.write('// Caller fills in length for writes.')
-                self.write('Pad(&buf, sizeof(%s));' % type_name)
-            else:
-                self.write('%s %s;' % (type_name, name))
-                self.copy_primitive(name)
         else:
             assert field.type.is_expr
             self.write(
@@ -425,12 +682,85 @@ class GenXproto:
             for expr in case.type.expr
         ])
 
-        with Indent(self, 'if (%s) {' % condition, '}'):
-            with (ScopedFields(self, case.field_name, case.type.fields)
-                  if case.field_name else NullContext()):
-                for case_field in case.type.fields:
-                    assert case_field.wire
+        self.open_block('if (%s) {' % condition)
+        self.copy_case_fields(case)
+        self.close_block()
+
+    def copy_case_fields(self, case):
+        with (ScopedFields(self, case.field_name, case.type.fields)
+              if case.field_name else NullContext()):
+            for case_field in case.type.fields:
+                assert case_field.wire
+                if not self.copy_pad(case_field):
+                    self.flush_pad()
                     self.copy_field(case_field)
+            self.flush_pad()
+
+    # If |switch| only has cases that compare against distinct constants,
+    # returns the C++ case values for each case.  Otherwise returns None.
+    def switch_case_values(self, switch):
+        # Case labels are cast to the type of the switch expression, so
+        # values that only collide after truncation must be caught too.
+        size = self.switch_expr_size(switch)
+        if not size:
+            return None
+        mask = (1 << (8 * size)) - 1
+
+        values = []
+        seen = set()
+        for case in switch.bitcases:
+            if not case.type.is_case:
+                return None
+            for expr in case.type.expr:
+                value = self.case_value(expr)
+                if value is None or value & mask in seen:
+                    return None
+                seen.add(value & mask)
+            values.append([self.expr(expr) for expr in case.type.expr])
+        return values
+
+    # Returns the size in bytes of the switch expression of |switch|, or
+    # None if it isn't a plain field reference.
+    def switch_expr_size(self, switch):
+        expr = switch.expr
+        if expr.op is not None or expr.nmemb or not expr.lenfield_name:
+            return None
+        field = self.field_from_scope(expr.lenfield_name)
+        return field.type.size if field else None
+
+    # Returns the integer value of the case expression |expr|, or None if
+    # it isn't a literal or an enum item with a known value.
+    def case_value(self, expr):
+        if expr.op is None and expr.nmemb:
+            return expr.nmemb
+        if expr.op != 'enumref':
+            return None
+        enum = expr.lenfield_type
+        try:
+            for name, value in enum.bits:
+                if name == expr.lenfield_name:
+                    return 1 << int(value, 0)
+            for name, value in enum.values:
+                if name == expr.lenfield_name:
+                    return int(value, 0)
+        except ValueError:
+            pass
+        return None
+
+    # Generates a C++ switch statement for |switch|, which lets the
+    # compiler use a jump table instead of testing each case in turn.
+    def copy_switch_statement(self, switch, switch_var, case_values):
+        self.open_block('switch (%s) {' % switch_var)
+        for case, values in zip(switch.bitcases, case_values):
+            for value in values[:-1]:
+                self.write('case static_cast<decltype(%s)>(%s):' %
+                           (switch_var, value))
+            self.open_block('case static_cast<decltype(%s)>(%s): {' %
+                            (switch_var, values[-1]))
+            self.copy_case_fields(case)
+            self.write('break;')
+            self.close_block()
+        self.close_block()
 
     def declare_switch(self, field):
         t = field.type
@@ -451,13 +781,28 @@ class GenXproto:
                 scope_fields.append(case)
             else:
                 scope_fields.extend(case.type.fields)
-        with Indent(self, '{', '}'), ScopedFields(self, name, scope_fields):
+        self.open_block()
+        with ScopedFields(self, name, scope_fields):
             switch_var = name + '_expr'
             self.write('auto %s = %s;' % (switch_var, self.expr(t.expr)))
-            for case in t.bitcases:
-                self.copy_case(case, switch_var)
+            case_values = self.switch_case_values(t)
+            all_bitcases = all([case.type.is_bitcase for case in t.bitcases])
+            if case_values:
+                self.copy_switch_statement(t, switch_var, case_values)
+            elif all_bitcases and len(t.bitcases) > 1:
+                # No bitcase can match if no bits are set.
+                self.open_block('if (%s) {' % switch_var)
+                for case in t.bitcases:
+                    self.copy_case(case, switch_var)
+                self.close_block()
+            else:
+                for case in t.bitcases:
+                    self.copy_case(case, switch_var)
+        self.close_block()
 
-    def declare_list(self, field):
+    # Lists that are inputs to a request (|is_input|) are declared as spans
+    # so callers can pass data without copying it into the request.
+    def declare_list(self, field, is_input):
         t = field.type
         type_name = self.qualtype(field.type)
         name = safe_name(field.field_name)
@@ -468,11 +813,14 @@ class GenXproto:
         else:
             if type_name == 'void':
                 # xcb uses void* in some places, but we prefer to use
-                # std::vector<T> when possible.  Use T=uint8_t instead of
-                # T=void for containers.
-                type_name = 'std::vector<uint8_t>'
+                # std::vector<T> or base::span<T> when possible.  Use
+                # T=uint8_t instead of T=void for containers.
+                type_name = ('base::span<const uint8_t>'
+                             if is_input else 'std::vector<uint8_t>')
             elif type_name == 'char':
                 type_name = 'std::string'
+            elif is_input:
+                type_name = 'base::span<const %s>' % type_name
             else:
                 type_name = 'std::vector<%s>' % type_name
         self.write('%s %s{};' % (type_name, name))
@@ -488,16 +836,29 @@ class GenXproto:
             else:
                 left = 'static_cast<size_t>(%s)' % size
                 self.write('DCHECK_EQ(%s, %s.size());' % (left, name))
-        with Indent(self, 'for (auto& %s_elem : %s) {' % (name, name), '}'):
-            elem_name = name + '_elem'
-            elem_type = t.member
-            if elem_type.is_simple or elem_type.is_union:
-                self.copy_primitive(elem_name)
+        elem_type = t.member
+        elem_size = self.elem_wire_size(elem_type)
+        if elem_size:
+            # std::string::data() is const until C++17.
+            if self.qualtype(elem_type) == 'char':
+                data = '&%s[0]' % name
             else:
-                assert elem_type.is_container
-                self.copy_container(elem_type, elem_name)
+                data = '%s.data()' % name
+            self.copy_flat(data, '%s.size()' % name)
+            self.advance(elem_size * t.nmemb if t.nmemb else None)
+            return
+        # Each element starts at a different offset.
+        self.offset = None
+        self.open_block('for (auto& %s_elem : %s) {' % (name, name))
+        elem_name = name + '_elem'
+        if elem_type.is_simple or elem_type.is_union:
+            self.copy_primitive(elem_name)
+        else:
+            assert elem_type.is_container
+            self.copy_container(elem_type, elem_name)
+        self.close_block()
 
-    def declare_field(self, field):
+    def declare_field(self, field, is_input=False):
         t = field.type
         name = safe_name(field.field_name)
 
@@ -507,7 +868,7 @@ class GenXproto:
         if t.is_switch:
             self.declare_switch(field)
         elif t.is_list:
-            self.declare_list(field)
+            self.declare_list(field, is_input)
         else:
             self.write('%s %s{};' % (self.qualtype(field.type), name))
 
@@ -517,26 +878,31 @@ class GenXproto:
 
         self.write('// ' + name)
         if t.is_pad:
-            if t.align > 1:
-                assert t.nmemb == 1
-                assert t.align in (2, 4)
-                self.write('Align(&buf, %d);' % t.align)
-            else:
-                self.write('Pad(&buf, %d);' % t.nmemb)
+            # Only reached when the offset isn't known statically.
+            self.write('Align(&buf, %d);' % t.align)
         elif not field.visible:
             self.copy_special_field(field)
+            self.advance(t.size)
         elif t.is_switch:
+            self.offset = None
             self.copy_switch(field)
         elif t.is_list:
             self.copy_list(field)
         elif t.is_union:
             self.copy_primitive(name)
+            self.offset = None
+        elif t.is_container and self.flat_wire_size(t):
+            # Read() and Write() copy IsFlatWire structs with one memcpy.
+            self.copy_primitive(name)
+            self.advance(self.flat_wire_size(t))
         elif t.is_container:
-            with Indent(self, '{', '}'):
-                self.copy_container(t, name)
+            self.open_block()
+            self.copy_container(t, name)
+            self.close_block()
         else:
             assert t.is_simple
             self.copy_primitive(name)
+            self.advance(t.size)
 
     def declare_enum(self, enum):
         def declare_enum_entry(name, value):
@@ -557,28 +923,44 @@ class GenXproto:
     def declare_container(self, struct):
         name = struct.name[-1] + self.type_suffix(struct)
         self.undef(name)
-        with Indent(self, 'struct %s {' % name, '};'):
-            for field in struct.fields:
-                field.parent = struct
-                self.declare_field(field)
+        flat_size = self.flat_wire_size(struct)
+        is_request = self.type_suffix(struct) == 'Request'
+        self.open_block('struct %s {' % name)
+        for field in struct.fields:
+            field.parent = struct
+            if flat_size and field.type.is_pad:
+                self.write('uint8_t %s[%d]{};' %
+                           (safe_name(field.field_name), field.type.nmemb))
+            else:
+                self.declare_field(field, is_request)
+        self.close_block('};')
+        if flat_size:
+            self.write(
+                'static_assert(sizeof(%s) == %d, "");' % (name, flat_size))
+            self.flat_structs.append(name)
         self.write()
 
     def copy_container(self, struct, name):
         assert not struct.is_union
         with ScopedFields(self, name, struct.fields):
             for field in struct.fields:
-                if field.wire:
+                if field.wire and not self.copy_pad(field):
+                    if self.flush_pad():
+                        self.write()
                     self.copy_field(field)
                     self.write()
+            if self.flush_pad():
+                self.write()
 
     def declare_union(self, union):
         name = union.name[-1]
-        with Indent(self, 'union %s {' % name, '};'):
-            self.write('%s() { memset(this, 0, sizeof(*this)); }' % name)
-            self.write()
-            for field in union.fields:
-                type_name = self.qualtype(field.type)
-                self.write('%s %s;' % (type_name, safe_name(field.field_name)))
+        self.open_block('union %s {' % name)
+        self.write('%s() { memset(this, 0, sizeof(*this)); }' % name)
+        self.write()
+        for field in union.fields:
+            type_name = self.qualtype(field.type)
+            self.write('%s %s;' % (type_name, safe_name(field.field_name)))
+        self.close_block('};')
         self.write(
             'static_assert(std::is_trivially_copyable<%s>::value, "");' % name)
         self.write()
@@ -614,10 +996,12 @@ class GenXproto:
         self.write('Future<%s>' % reply_name)
         self.write('%s(' % method_name)
         with Indent(self, '    const %s& request) {' % request_name, '}'):
-            self.namespace = ['x11', self.class_name]
+            self.namespace = ('x11', self.class_name)
             self.write('WriteBuffer buf;')
+            self.write('buf.reserve(%s);' % self.wire_size(request, 'request'))
             self.write()
             self.is_read = False
+            self.offset = 0
             self.copy_container(request, 'request')
             self.write(
                 'return x11::SendRequest<%s>(display_, &buf);' % reply_name)
@@ -628,13 +1012,17 @@ class GenXproto:
             self.write('std::unique_ptr<%s>' % reply_name)
             sig = 'detail::ReadReply<%s>(const uint8_t* buffer) {' % reply_name
             with Indent(self, sig, '}'):
-                self.namespace = ['x11']
+                self.namespace = ('x11', )
                 self.write('ReadBuffer buf{buffer, 0UL};')
                 self.write('auto reply = std::make_unique<%s>();' % reply_name)
                 self.write()
                 self.is_read = True
+                self.offset = 0
                 self.copy_container(reply, '(*reply)')
-                self.write('Align(&buf, 4);')
+                if self.offset is None:
+                    self.write('Align(&buf, 4);')
+                elif self.offset % 4:
+                    self.write('Pad(&buf, %d);' % (-self.offset % 4))
                 offset = 'buf.offset < 32 ? 0 : buf.offset - 32'
                 self.write('DCHECK_EQ(%s, 4 * length);' % offset)
                 self.write()
@@ -642,14 +1030,15 @@ class GenXproto:
             self.write()
 
     def declare_type(self, item, name):
+        kind = self.kinds.get(item.__class__)
         if item.is_union:
             self.declare_union(item)
-        elif isinstance(item, self.xcbgen.xtypes.Request):
+        elif kind == 'Request':
             self.declare_request(item)
         elif item.is_container:
             item.name = name
             self.declare_container(item)
-        elif isinstance(item, self.xcbgen.xtypes.Enum):
+        elif kind == 'Enum':
             self.declare_enum(item)
         else:
             assert item.is_simple
@@ -658,7 +1047,8 @@ class GenXproto:
 
     def gen_header(self):
         self.file = self.args.headerfile
-        include_guard = self.args.headerfile.name.replace('/', '_').replace(
+        self.write(self.hash_line)
+        include_guard = self.args.headerfile.replace('/', '_').replace(
             '.', '_').upper() + '_'
         self.write('#ifndef ' + include_guard)
         self.write('#define ' + include_guard)
@@ -670,6 +1060,7 @@ class GenXproto:
         self.write('#include <vector>')
         self.write()
         self.write('#include "base/component_export.h"')
+        self.write('#include "base/containers/span.h"')
         self.write('#include "ui/gfx/x/xproto_types.h"')
         for direct_import in self.module.direct_imports:
             self.write('#include "%s.h"' % direct_import[-1])
@@ -682,7 +1073,7 @@ class GenXproto:
         name = self.class_name
         self.undef(name)
         with Indent(self, 'class COMPONENT_EXPORT(X11) %s {' % name, '};'):
-            self.namespace = ['x11', self.class_name]
+            self.namespace = ('x11', self.class_name)
             self.write('public:')
             self.write('explicit %s(XDisplay* display);' % name)
             self.write()
@@ -694,12 +1085,19 @@ class GenXproto:
             self.write('XDisplay* const display_;')
 
         self.write()
+        for struct_name in self.flat_structs:
+            self.write('template <>')
+            self.write('struct IsFlatWire<%s::%s> : std::true_type {};' %
+                       (self.class_name, struct_name))
+            self.write()
         self.write('}  // namespace x11')
         self.write()
         self.write('#endif  // ' + include_guard)
+        self.flush()
 
     def gen_source(self):
         self.file = self.args.sourcefile
+        self.write(self.hash_line)
         self.write('#include "%s.h"' % self.module.namespace.header)
         self.write()
         self.write('#include <xcb/xcb.h>')
@@ -715,12 +1113,63 @@ class GenXproto:
             '%s::%s(XDisplay* display) : display_(display) {}' % (name, name))
         self.write()
         for (name, item) in self.module.all:
-            if isinstance(item, self.xcbgen.xtypes.Request):
+            if self.kinds.get(item.__class__) == 'Request':
                 self.define_request(item)
         self.write('}  // namespace x11')
+        self.flush()
+
+    # Returns true if |path| was generated from the same inputs.
+    def is_up_to_date(self, path):
+        if not os.path.exists(path):
+            return False
+        with open(path) as f:
+            return f.readline() == self.hash_line + '\n'
+
+    # Returns the paths of |xmlfile| and of every XML file it imports,
+    # directly or indirectly.  Like xcbgen, imports are looked up in the
+    # directory of the importing file.
+    def xml_closure(self, xmlfile):
+        paths = set()
+        pending = [xmlfile]
+        while pending:
+            path = pending.pop()
+            if path in paths:
+                continue
+            paths.add(path)
+            root = xml.etree.ElementTree.parse(path).getroot()
+            for node in root.iter('import'):
+                pending.append(
+                    os.path.join(os.path.dirname(path),
+                                 node.text.strip() + '.xml'))
+        return sorted(paths)
+
+    # Returns a hash of everything the generated files depend on: the
+    # command line, the XML file and its imports, xcbgen and this script.
+    def compute_hash(self):
+        digest = hashlib.sha256()
+        digest.update(repr(sorted(vars(self.args).items())).encode('utf-8'))
+        xcbgen_dir = os.path.dirname(os.path.abspath(self.xcbgen.__file__))
+        xcbgen_sources = [
+            os.path.join(xcbgen_dir, name)
+            for name in sorted(os.listdir(xcbgen_dir)) if name.endswith('.py')
+        ]
+        paths = (self.xml_closure(self.args.xmlfile) + xcbgen_sources +
+                 [__file__])
+        for path in paths:
+            digest.update(path.encode('utf-8'))
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+        return digest.hexdigest()
 
     def generate(self):
-        self.module = self.xcbgen.state.Module(self.args.xmlfile.name, None)
+        # Leave the outputs untouched if none of their inputs changed, so
+        # that ninja doesn't rebuild their dependents.
+        self.hash_line = '// GEN-HASH: ' + self.compute_hash()
+        if (self.is_up_to_date(self.args.headerfile)
+                and self.is_up_to_date(self.args.sourcefile)):
+            return
+
+        self.module = self.xcbgen.state.Module(self.args.xmlfile, None)
         self.module.register()
         self.module.resolve()
 
@@ -733,9 +1182,10 @@ class GenXproto:
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('xmlfile', type=argparse.FileType('r'))
-    parser.add_argument('headerfile', type=argparse.FileType('w'))
-    parser.add_argument('sourcefile', type=argparse.FileType('w'))
+    # The output files are only opened once their contents are known.
+    parser.add_argument('xmlfile')
+    parser.add_argument('headerfile')
+    parser.add_argument('sourcefile')
     parser.add_argument('--sysroot')
     args = parser.parse_args()
 
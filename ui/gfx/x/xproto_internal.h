@@ -35,12 +35,25 @@ struct ReadBuffer {
   size_t offset = 0;
 };
 
+// On the wire, X11 types are always aligned to their size.  Flat structs are
+// aligned to their largest member.
+template <typename T>
+constexpr size_t WireAlignment() {
+  return IsFlatWire<T>::value ? alignof(T) : sizeof(T);
+}
+
+// Lists of these types may be copied with a single memcpy.
+template <typename T>
+constexpr bool IsFlatWireElement() {
+  return std::is_arithmetic<T>::value || std::is_enum<T>::value ||
+         IsFlatWire<T>::value;
+}
+
 template <typename T>
 void Write(const T* t, WriteBuffer* buf) {
   static_assert(std::is_trivially_copyable<T>::value, "");
-  // On the wire, X11 types are always aligned to their size.  This is a sanity
-  // check to ensure padding etc are working properly.
-  DCHECK_EQ(buf->size() % sizeof(*t), 0UL);
+  // This is a sanity check to ensure padding etc are working properly.
+  DCHECK_EQ(buf->size() % WireAlignment<T>(), 0UL);
   const uint8_t* start = reinterpret_cast<const uint8_t*>(t);
   std::copy(start, start + sizeof(*t), std::back_inserter(*buf));
 }
@@ -48,13 +61,34 @@ void Write(const T* t, WriteBuffer* buf) {
 template <typename T>
 void Read(T* t, ReadBuffer* buf) {
   static_assert(std::is_trivially_copyable<T>::value, "");
-  // On the wire, X11 types are always aligned to their size.  This is a sanity
-  // check to ensure padding etc are working properly.
-  DCHECK_EQ(buf->offset % sizeof(*t), 0UL);
+  // This is a sanity check to ensure padding etc are working properly.
+  DCHECK_EQ(buf->offset % WireAlignment<T>(), 0UL);
   memcpy(t, buf->data + buf->offset, sizeof(*t));
   buf->offset += sizeof(*t);
 }
 
+// Writes a list of |count| objects of type |T| with a single copy.
+template <typename T>
+void WriteFlat(const T* t, size_t count, WriteBuffer* buf) {
+  static_assert(IsFlatWireElement<T>(), "");
+  if (!count)
+    return;
+  DCHECK_EQ(buf->size() % WireAlignment<T>(), 0UL);
+  const uint8_t* start = reinterpret_cast<const uint8_t*>(t);
+  buf->insert(buf->end(), start, start + sizeof(T) * count);
+}
+
+// Reads a list of |count| objects of type |T| with a single memcpy.
+template <typename T>
+void ReadFlat(T* t, size_t count, ReadBuffer* buf) {
+  static_assert(IsFlatWireElement<T>(), "");
+  if (!count)
+    return;
+  DCHECK_EQ(buf->offset % WireAlignment<T>(), 0UL);
+  memcpy(t, buf->data + buf->offset, sizeof(T) * count);
+  buf->offset += sizeof(T) * count;
+}
+
 inline void Pad(WriteBuffer* buf, size_t amount) {
   buf->resize(buf->size() + amount, '\0');
 }
@@ -11,6 +11,7 @@
 
 #include <cstdint>
 #include <memory>
+#include <type_traits>
 
 #include "base/bind.h"
 #include "base/callback.h"
@@ -32,6 +33,12 @@ std::unique_ptr<Reply> ReadReply(const uint8_t* buffer);
 
 using Error = xcb_generic_error_t;
 
+// Generated code specializes this to std::true_type for every struct whose
+// in-memory layout is byte-identical to its wire format.  Such structs are
+// copied with a single memcpy.
+template <typename T>
+struct IsFlatWire : std::false_type {};
+
 template <class Reply>
 class Future;
 